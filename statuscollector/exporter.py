@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 # exporter.py - read subscriber state from UISP
 
-import logging, threading, time, yaml
-from collections import namedtuple
-from datetime import datetime
+import hashlib, logging, signal, string, threading, time, yaml
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 from enum import Enum
+from http.server import ThreadingHTTPServer
+from operator import itemgetter
 
-import botocore, boto3, prometheus_client, requests.exceptions
+import orjson, prometheus_client
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.exposition import MetricsHandler
 
 from uisp import UispClient, Organizations, ClientStatus, ServiceStatus
 
@@ -31,24 +36,42 @@ EMAIL_ERRORS = prometheus_client.Gauge('uisp_email_error_count',
                                        'number of email sending errors', ['organization'])
 
 
+_ses_clients, _ses_lock = {}, threading.Lock()
+
+
+def get_ses_client(sesconfig):
+    """Returns the SES client for sesconfig, creating it on first use and
+    sharing it with every later caller (and thread) that has the same
+    region and credentials."""
+    key = (sesconfig['region'], sesconfig['access_key'], sesconfig['secret_key'])
+    with _ses_lock:
+        # creating a client is not thread-safe, but using one is
+        if key not in _ses_clients:
+            # boto3 is slow to import and most processes never send email,
+            # so we defer importing it until the first send
+            import boto3, botocore.config
+            _ses_clients[key] = boto3.client(
+                'ses',
+                region_name=sesconfig['region'],
+                aws_access_key_id=sesconfig['access_key'],
+                aws_secret_access_key=sesconfig['secret_key'],
+                config=botocore.config.Config(max_pool_connections=16, tcp_keepalive=True,
+                                              retries={ 'mode': 'standard', 'max_attempts': 3 })
+            )
+        return _ses_clients[key]
+
+
 class EmailSender:
     def __init__(self, config):
-        if 'ses' not in config:
+        self.sesconfig = config.get('ses')
+        if not self.sesconfig:
             LOGGER.warning('email sending inhibited because SES not in config')
-            self.awsclient = None
-        else:
-            self.awsclient = boto3.client(
-                'ses',
-                region_name=config['ses']['region'],
-                aws_access_key_id=config['ses']['access_key'],
-                aws_secret_access_key=config['ses']['secret_key']
-            )
 
     def send(self, source, subject, body, to, cc=[]):
-        if not self.awsclient:
+        if not self.sesconfig:
             LOGGER.warning(f'not sending email to {",".join(to + cc)} because ses not present in config')
             return
-        response = self.awsclient.send_email(
+        response = get_ses_client(self.sesconfig).send_email(
             Destination = {
                 'ToAddresses': to,
                 'CcAddresses': cc
@@ -70,96 +93,121 @@ class EmailSender:
         return response
 
 
-class ModelGauge:
-    def __init__(self, name, helptext, labelmap, idlabel, model, selector):
-        """
-        Model is a function of zero arguments that returns a map from id
-        to model dictionary. Each key of labelmap is expected to be a key
-        of each model dictionary.
+def label_extractor(keys):
+    """Returns a function from model dictionary to the tuple of its
+    (string) values for keys, with '' for any key that is missing.
+
+    The function is generated once per gauge so that extracting labels
+    costs one call rather than a Python-level loop over keys.
+    """
+    body = ', '.join(f'str(d.get({k!r}, \'\'))' for k in keys)
+    return eval(f'lambda d: ({body}{"," if len(keys) == 1 else ""})')
 
-        Selector is a function from model dictionary to the (numeric) value
-        of the gauge.
 
-        idlabel is the name of the key that is the unique primary key of
-        the model, and the model must be a map from that primary key to
-        the model dictionary for that key. Only the labels corresponding to
-        current model dictionary will be exported (not labels corresponding
-        to an earlier model dictionary).
+class ModelCollector:
+    def __init__(self, prepare=None):
         """
-        self.labels = sorted(labelmap.keys())
-        self.idlabel, self.model, self.selector = idlabel, model, selector
-        self.id2labelvalues_map = {}
-        self.gauge = prometheus_client.Gauge(name, helptext, [labelmap[j] for j in self.labels])
-        self.lock = threading.Lock()
-        self.old_model_keys = set()
-        self.name = name
-        self.update()
-
-    def update(self):
-        """Interrogate the model and update all labels to match.
-
-        You must call this when the model changes, or the gauges won't update.
-
-        If a primary key goes away (that is, there was a value of idlabel
-        in the old model but there is not in the new model), we remove
-        its entry / label from the gauge.
+        A prometheus_client collector that exports any number of gauges,
+        each computed from a model, in a single pass per scrape. Nothing is
+        retained between scrapes, so when a primary key goes away from the
+        model its labels simply stop being exported.
+
+        Prepare, if not None, is a function of zero arguments called once
+        at the start of each scrape (for example, to refresh the models).
         """
-        model = self.model()
-        with self.lock:
-            for (k, new_model_dict) in model.items():
-                # if this assertion fails, the model is invalid. each key in a
-                # valid model should have a model dictionary mapping
-                # self.idlabel to the key
-                assert k == new_model_dict[self.idlabel], (k, new_model_dict)
-                self.old_model_keys.discard(k)
-                self._update(new_model_dict)
-            # now remove all keys that were in the old model but not the new
-            for k in self.old_model_keys:
-                old_labelvalues = self.id2labelvalues_map.get(k)
-                assert old_labelvalues, (k, self.old_model_keys)
-                try:
-                    self.gauge.remove(*old_labelvalues)
-                    LOGGER.info(f'removed deleted primary key {old_labelvalues}')
-                except KeyError:
-                    LOGGER.info(f'primary key {old_labelvalues} could not be deleted as it was not present')
-            self.old_model_keys = set(model.keys())
-
-    def _update(self, new_kv):
-        new_labelvalues = [new_kv.get(s, '') for s in self.labels]
-        idvalue = new_kv[self.idlabel]
-        old_labelvalues = self.id2labelvalues_map.get(idvalue)
-        if old_labelvalues != new_labelvalues:
-            self.id2labelvalues_map[idvalue] = new_labelvalues
-            def _select():
-                assert idvalue in self.model(), (self.labels, idvalue, self.model())
-                return self.selector(self.model()[idvalue])
-            self.gauge.labels(*new_labelvalues).set_function(_select)
-            if old_labelvalues:
-                self.gauge.remove(*old_labelvalues)
-
-
-class UispClientGauge:
-    def __init__(self, metric, metric_desc, copylabels, model, value_selector):
+        self.prepare = prepare
+        self.specs = []
+
+    def add_gauge(self, name, helptext, labelmap, model, selector):
         """
         Model is a function of zero arguments that returns a map from id
-        to dictionary.
+        to model dictionary. Each key of labelmap is a key of the model
+        dictionaries, and its value is the name of the exported label.
+
+        Selector is a function from model dictionary to the (numeric) value
+        of the gauge.
         """
-        labelmap = { k: k for k in copylabels }
-        labelmap['userIdent'] = 'nlid'  # 'userIdent' is renamed nlid
-        def _selector(model_dict):
-            v = value_selector(model_dict)
-            if v is None or v is False:
-                return 0
-            if v is True:
-                return 1
-            if isinstance(v, str):
-                # then it should be a date 2023-10-03T00:00:00-0700
-                return datetime.fromisoformat(v).timestamp()
-            return v
-        self.gauge = ModelGauge(metric, metric_desc, labelmap, 'id', model, _selector)
-
-    def update(self):
-        return self.gauge.update()
+        keys = sorted(labelmap.keys())
+        self.specs.append((name, helptext, label_extractor(keys), [labelmap[k] for k in keys], model, selector))
+
+    def collect(self):
+        if self.prepare:
+            self.prepare()
+        for (name, helptext, extract, labelnames, model, selector) in self.specs:
+            family = GaugeMetricFamily(name, helptext, labels=labelnames)
+            for model_dict in model().values():
+                family.add_metric(extract(model_dict), selector(model_dict))
+            yield family
+
+
+# these UISP fields are dates like 2023-10-03T00:00:00-0700, which we
+# convert to timestamps once per refresh rather than once per scrape
+CLIENT_DATE_KEYS = ('invitationEmailSentDate', 'registrationDate')
+SERVICE_DATE_KEYS = ('activeFrom', 'activeTo', 'contractEndDate', 'lastInvoicedDate')
+
+
+_get_id = itemgetter('id')
+
+
+# passed to UispClient as not_modified, to learn that a result is unchanged
+UNMODIFIED = object()
+
+
+def parse_dates(d, keys):
+    for k in keys:
+        v = d.get(k)
+        if isinstance(v, str):
+            d[k] = datetime.fromisoformat(v).timestamp()
+
+
+def uisp_gauge_value(v):
+    if v is None or v is False:
+        return 0
+    if v is True:
+        return 1
+    return v
+
+
+PASTDUE_SUMMARY = string.Template("""Hello $name folks,
+
+This is your periodic subscriber summary from Next Level Infrastructure.
+
+You have $active active subscribers in our billing database, of which $noautopay are not on autopay.
+
+You have $pastdue subscribers (active and inactive) with an overdue invoice. They are:
+   $pastdue_list
+
+Please bug them.
+
+FYI, the active subscribers who do not have a valid autopay credit card set up are:
+   $noautopay_list
+""")
+
+NO_PASTDUE_SUMMARY = string.Template("""Hello $name folks,
+
+This is your periodic subscriber summary from Next Level Infrastructure.
+
+Congratulations for having no past due subscribers! Y'all rock!
+
+You have $active active subscribers in our billing database, of which
+$noautopay are not on autopay.
+
+FYI, the active subscribers who do not have a valid autopay credit card set up are:
+   $noautopay_list
+""")
+
+
+def render_summary(name, active, pastdue, noautopay, printable):
+    """Returns the (subject, body) of the summary email for organization
+    name, given its client lists and a function formatting one client."""
+    lineend = '\n   '
+    noautopay_list = lineend.join(map(printable, noautopay))
+    if pastdue:
+        subject = f'NLI summary: {len(pastdue)} past due subscribers for { name }'
+        return (subject, PASTDUE_SUMMARY.substitute(name=name, active=len(active), noautopay=len(noautopay), pastdue=len(pastdue),
+                                                     pastdue_list=lineend.join(map(printable, pastdue)), noautopay_list=noautopay_list))
+    subject = f'NLI summary: no past due subscribers for { name }!'
+    return (subject, NO_PASTDUE_SUMMARY.substitute(name=name, active=len(active), noautopay=len(noautopay), noautopay_list=noautopay_list))
 
 
 class PrometheusWrapper:
@@ -174,6 +222,21 @@ class PrometheusWrapper:
 
     """
     MIN_UPDATE_INTERVAL = 60 * 60  # seconds
+    # when refreshes keep finding nothing changed, we back off up to this
+    MAX_UPDATE_INTERVAL = 6 * 60 * 60  # seconds
+    UNCHANGED_REFRESHES_BEFORE_BACKOFF = 2
+    # at most this many summary emails are sent concurrently
+    MAX_EMAIL_WORKERS = 4
+    # the background thread checks this often whether a refresh is due
+    REFRESH_POLL_INTERVAL = 60  # seconds
+    # at most this many organizations are fetched from UISP concurrently
+    MAX_FETCH_WORKERS = 16
+    # service plans rarely change, so we fetch them at most this often
+    SERVICE_PLANS_TTL = 24 * 60 * 60  # seconds
+    # organizations whose summary email failed are retried this often, at
+    # most this many times, before waiting for next week's
+    EMAIL_RETRY_INTERVAL = 5 * 60  # seconds
+    EMAIL_RETRY_ATTEMPTS = 6
                             
     def __init__(self, config, emailday, emailhour):
         self.config, self.emailday, self.emailhour = config, emailday, emailhour
@@ -181,14 +244,39 @@ class PrometheusWrapper:
         self.uisp = UispClient(self.config)
         self.uisporgs = self.uisp.get_organizations()
         
-        self.last_update, self.last_email = 0, 0
+        self.last_update = 0
+        self.update_interval = self.MIN_UPDATE_INTERVAL
+        self._snapshot_digest, self._unchanged_refreshes = None, 0
         self.errors = 0
-        self.lock = threading.Lock()
+        # _time_lock guards the last_update bookkeeping, and
+        # _snapshot_lock the (rare) publication of a new set of maps.
+        # neither is ever held across network requests.
+        self._time_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
         self.emailer = EmailSender(self.config)
+        self._email_orgs = [(name, d) for (name, d) in self.config.get('organizations', {}).items() if d.get('pastdue_report_to')]
+        self._email_enabled = 0 <= emailday <= 6 and 0 <= emailhour <= 23 and bool(self._email_orgs)
+        # SES calls are network-bound, so we send each organization's email
+        # on its own thread. the pool size also keeps us well under the SES
+        # send rate limit.
+        self.email_executor = ThreadPoolExecutor(max_workers=self.MAX_EMAIL_WORKERS)
         self.id2allclients_map = {}
-        self.id2client_map = {}
         self.id2service_map = {}
-        self.gauges = []
+        self.serviceplans, self.serviceplans_time = {}, 0
+        # organizationId -> (clients, services, contacts) maps from the last
+        # successful refresh, reused while UISP reports them unchanged
+        self.org_parts = {}
+        # indexes for _send_email: organizationId -> its (active, pastdue,
+        # noautopay) client lists, and servicePlanId -> organizationId of
+        # its first active service
+        self.summary_by_org, self.orgid_by_plan = {}, {}
+        # client id -> printable_client() of that client in this snapshot,
+        # filled in as _send_email needs them
+        self.printable_by_id = {}
+        # scrapes are served from the most recent snapshot; refreshing
+        # happens only on the background thread started below
+        self.collector = ModelCollector()
+        self.id2contact_map = {}
         self._maybe_refresh()
 
         clientlabels = [
@@ -199,21 +287,17 @@ class PrometheusWrapper:
             'username', 'isArchived', 
         ]
         def _clientmodel():
-            self._maybe_refresh()
             return self.id2allclients_map
-        def _stateselector(model_dict):
-            return ClientStatus.from_client(model_dict).value
-        self.gauges.append(UispClientGauge('uisp_client_state', 'UISP client state', clientlabels, _clientmodel, _stateselector))
+        self._add_gauge('uisp_client_state', 'UISP client state', clientlabels, _clientmodel, lambda d: d['_clientstate'])
         contactlabels = ['id', 'clientId', 'email', 'phone', 'name', 'types']
         def _contactmodel():
-            self._maybe_refresh()
-            return { contact['id']: dict(contact, userIdent=client['userIdent'], types=','.join(sorted([t['name'] for t in contact['types']]))) for client in self.id2allclients_map.values() for contact in client['contacts'] }
-        self.gauges.append(UispClientGauge('uisp_client_contact', 'UISP client contact info', contactlabels, _contactmodel, lambda model_dict: 1))
-        self.gauges.append(UispClientGauge('uisp_client_balance', 'UISP client balance, negative means client owes us', ['id', 'currencyCode'], _clientmodel, lambda d: d['accountBalance']))
-        self.gauges.append(UispClientGauge('uisp_client_pastdue', 'UISP client pastdue balance', ['id'], _clientmodel, lambda d: d['hasOverdueInvoice']))
-        self.gauges.append(UispClientGauge('uisp_client_autopay', 'UISP client has autopay enabled', ['id'], _clientmodel, lambda d: d['hasAutopayCreditCard']))
-        self.gauges.append(UispClientGauge('uisp_client_invited_ts', 'UISP client invitation timestamp', ['id'], _clientmodel, lambda d: d['invitationEmailSentDate']))
-        self.gauges.append(UispClientGauge('uisp_client_registered_ts', 'UISP client registration timestamp', ['id'], _clientmodel, lambda d: d['registrationDate']))
+            return self.id2contact_map
+        self._add_gauge('uisp_client_contact', 'UISP client contact info', contactlabels, _contactmodel, lambda model_dict: 1)
+        self._add_gauge('uisp_client_balance', 'UISP client balance, negative means client owes us', ['id', 'currencyCode'], _clientmodel, lambda d: d['accountBalance'])
+        self._add_gauge('uisp_client_pastdue', 'UISP client pastdue balance', ['id'], _clientmodel, lambda d: d['hasOverdueInvoice'])
+        self._add_gauge('uisp_client_autopay', 'UISP client has autopay enabled', ['id'], _clientmodel, lambda d: d['hasAutopayCreditCard'])
+        self._add_gauge('uisp_client_invited_ts', 'UISP client invitation timestamp', ['id'], _clientmodel, lambda d: d['invitationEmailSentDate'])
+        self._add_gauge('uisp_client_registered_ts', 'UISP client registration timestamp', ['id'], _clientmodel, lambda d: d['registrationDate'])
 
         servicelabels = [
             'id', 'clientId', 'prepaid', 'addressGpsLat', 'addressGpsLon',
@@ -221,22 +305,41 @@ class PrometheusWrapper:
             'downloadSpeed', 'uploadSpeed'
         ]
         def _servicemodel():
-            self._maybe_refresh()
             return self.id2service_map
-        self.gauges.append(UispClientGauge('uisp_service_state', 'UISP service state', servicelabels, _servicemodel, lambda d: d['status']))
-        self.gauges.append(UispClientGauge('uisp_service_active_from_ts', 'UISP service start timestamp', ['id', 'clientId'], _servicemodel, lambda d: d['activeFrom']))
-        self.gauges.append(UispClientGauge('uisp_service_active_to_ts', 'UISP service end timestamp, 0=ongoing', ['id', 'clientId'], _servicemodel, lambda d: d['activeTo']))
-        self.gauges.append(UispClientGauge('uisp_service_contract_end_ts', 'UISP service contract end timestamp, 0=no contract', ['id', 'clientId'], _servicemodel, lambda d: d['contractEndDate']))
-        self.gauges.append(UispClientGauge('uisp_service_last_invoiced_ts', 'UISP service contract last invoiced timestamp, 0=never invoiced', ['id', 'clientId'], _servicemodel, lambda d: d['lastInvoicedDate']))
+        self._add_gauge('uisp_service_state', 'UISP service state', servicelabels, _servicemodel, lambda d: d['status'])
+        self._add_gauge('uisp_service_active_from_ts', 'UISP service start timestamp', ['id', 'clientId'], _servicemodel, lambda d: d['activeFrom'])
+        self._add_gauge('uisp_service_active_to_ts', 'UISP service end timestamp, 0=ongoing', ['id', 'clientId'], _servicemodel, lambda d: d['activeTo'])
+        self._add_gauge('uisp_service_contract_end_ts', 'UISP service contract end timestamp, 0=no contract', ['id', 'clientId'], _servicemodel, lambda d: d['contractEndDate'])
+        self._add_gauge('uisp_service_last_invoiced_ts', 'UISP service contract last invoiced timestamp, 0=never invoiced', ['id', 'clientId'], _servicemodel, lambda d: d['lastInvoicedDate'])
+
+        prometheus_client.REGISTRY.register(self.collector)
 
         self.errors_g = prometheus_client.Gauge('uisp_errors', 'Number of errors')
         self.errors_g.set_function(lambda: self.errors)
 
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+        if self._email_enabled:
+            self._schedule_email()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.REFRESH_POLL_INTERVAL)
+            self._maybe_refresh()
+
+    def _add_gauge(self, metric, metric_desc, copylabels, model, value_selector):
+        labelmap = { k: k for k in copylabels }
+        labelmap['userIdent'] = 'nlid'  # 'userIdent' is renamed nlid
+        self.collector.add_gauge(metric, metric_desc, labelmap, model, lambda d: uisp_gauge_value(value_selector(d)))
+
     def _maybe_refresh(self):
-        oldtime = -1
         newtime = time.time()
-        with self.lock:
-            if time.time() - self.last_update > self.MIN_UPDATE_INTERVAL:
+        # fast path: if no refresh is due, return without the lock. the
+        # check is repeated under the lock below.
+        if newtime - self.last_update <= self.update_interval:
+            return
+        oldtime = -1
+        with self._time_lock:
+            if time.time() - self.last_update > self.update_interval:
                 oldtime = self.last_update
                 self.last_update = newtime
             # safe to release the lock here because (we assume) that the
@@ -245,30 +348,69 @@ class PrometheusWrapper:
         if oldtime != -1:
             try:
                 self._refresh()
-                for g in self.gauges:
-                    g.update()
-            except requests.exceptions.ReadTimeout:
-                LOGGER.exception()
+            except Exception:
+                # this runs on the only refresh thread, so any failure (a
+                # request, a proxy's HTML error page, a malformed date) is
+                # logged and retried rather than ending the thread
+                LOGGER.exception('UISP refresh failed')
                 self.errors += 1
                 # reset the last update time so we try again pronto
-                with self.lock:
+                with self._time_lock:
                     if self.last_update == newtime:
                         self.last_update = oldtime
-        with self.lock:
-            now = datetime.utcnow()
-            if (self.emailday == now.weekday() and self.emailhour <= now.hour
-                and time.time() - self.last_email > 3600*12):
-                try:
-                    self._send_email()
-                    self.last_email = self.last_update
-                except botocore.exceptions.ClientError:
-                    EMAIL_ERRORS.labels(organization='UNKNOWN').inc()
-                    LOGGER.exception()
-
-    def _send_email(self):
+
+    def _next_email_delay(self):
+        """Seconds from now until the next emailday at emailhour (UTC)."""
+        now = datetime.now(timezone.utc)
+        slot = now.replace(hour=self.emailhour, minute=0, second=0, microsecond=0) + timedelta(days=(self.emailday - now.weekday()) % 7)
+        if slot <= now:
+            slot += timedelta(days=7)
+        return (slot - now).total_seconds()
+
+    def _start_timer(self, delay, function, *args):
+        timer = threading.Timer(delay, function, args)
+        timer.daemon = True
+        timer.start()
+
+    def _schedule_email(self):
+        self._start_timer(self._next_email_delay(), self._email_and_reschedule)
+
+    def _email_and_reschedule(self):
+        # the weekly timer is re-armed regardless; organizations whose email
+        # failed are retried on their own shorter timer, and the others are
+        # not sent to again
+        self._email_and_retry(self._email_orgs, 0)
+        self._schedule_email()
+
+    def _email_and_retry(self, orgs, attempt):
+        try:
+            failed = self._send_email(orgs)
+        except Exception:
+            LOGGER.exception('failed to send summary emails')
+            failed = orgs
+        if failed:
+            if attempt < self.EMAIL_RETRY_ATTEMPTS:
+                LOGGER.info(f'will retry summary emails of {", ".join(name for (name, _) in failed)} in {self.EMAIL_RETRY_INTERVAL} seconds')
+                self._start_timer(self.EMAIL_RETRY_INTERVAL, self._email_and_retry, failed, attempt + 1)
+            else:
+                LOGGER.error(f'giving up on this week\'s summary emails of {", ".join(name for (name, _) in failed)}')
+
+    def _send_email(self, orgs):
+        """Sends the summary email of each (name, config) in orgs, and
+        returns those whose email could not be sent."""
         # see https://codelovingyogi.medium.com/sending-emails-using-aws-simple-email-service-ses-220de9db4fc8
-        for (name, d) in self.config['organizations'].items():
-            report_to = d.get('pastdue_report_to')
+        with self._snapshot_lock:
+            summary_by_org, orgid_by_plan, printable_by_id = self.summary_by_org, self.orgid_by_plan, self.printable_by_id
+        def _printable(client):
+            # clients are often both past due and not on autopay, so each
+            # is formatted at most once per snapshot
+            p = printable_by_id.get(client['id'])
+            if p is None:
+                p = printable_by_id[client['id']] = self.uisp.printable_client(client)
+            return p
+        sends, failed = {}, []
+        for (name, d) in orgs:
+            report_to = d['pastdue_report_to']
             if report_to:
                 if isinstance(report_to, list):
                     dests = report_to
@@ -276,78 +418,172 @@ class PrometheusWrapper:
                     dests = [report_to]
                 else:
                     assert False, f'pastdue_report_to { report_to } for { name } has bad type'
-                clients = []
-                # this could be made more efficient
-                for service in self.id2service_map.values():
-                    if service['servicePlanId'] in d['billing_instructions'] and service['status'] == ServiceStatus.ACTIVE.value:
-                        orgid = self.id2allclients_map[service['clientId']]['organizationId']
-                        clients = [c for c in self.id2allclients_map.values() if c['organizationId'] == orgid]
-                        break
-                assert clients, d
-                active = [client for client in clients if ClientStatus.from_client(client) == ClientStatus.ACTIVE and not client['isArchived']]
-                nonarchived = [client for client in clients if not client['isArchived']]
-                pastdue = [client for client in nonarchived if client['hasOverdueInvoice']]
-                noautopay = [client for client in active if not client['hasAutopayCreditCard']]
-                lineend = '\n   '
-                def _printable(client):
-                    return self.uisp.printable_client(client)
-                if pastdue:
-                    subject = f'NLI summary: {len(pastdue)} past due subscribers for { name }'
-                    body = f"""Hello { name } folks,
-
-This is your periodic subscriber summary from Next Level Infrastructure.
-
-You have {len(active)} active subscribers in our billing database, of which {len(noautopay)} are not on autopay.
-
-You have {len(pastdue)} subscribers (active and inactive) with an overdue invoice. They are:
-   {lineend.join([_printable(p) for p in pastdue])}
-
-Please bug them.
-
-FYI, the active subscribers who do not have a valid autopay credit card set up are:
-   {lineend.join([_printable(p) for p in noautopay])}
-"""
-                else:
-                    subject = f'NLI summary: no past due subscribers for { name }!'
-                    body = f"""Hello { name } folks,
-
-This is your periodic subscriber summary from Next Level Infrastructure.
-
-Congratulations for having no past due subscribers! Y'all rock!
-
-You have {len(active)} active subscribers in our billing database, of which
-{len(noautopay)} are not on autopay.
-
-FYI, the active subscribers who do not have a valid autopay credit card set up are:
-   {lineend.join([_printable(p) for p in noautopay])}
-"""
-                response = self.emailer.send(
+                orgid = next((orgid_by_plan[spid] for spid in d['billing_instructions'] if spid in orgid_by_plan), None)
+                if orgid not in summary_by_org:
+                    # e.g. no refresh has succeeded yet
+                    EMAIL_ERRORS.labels(organization=name).inc()
+                    LOGGER.error(f'no subscriber summary of {name} to send')
+                    failed.append((name, d))
+                    continue
+                (active, pastdue, noautopay) = summary_by_org[orgid]
+                (subject, body) = render_summary(name, active, pastdue, noautopay, _printable)
+                sends[self.email_executor.submit(
+                    self.emailer.send,
                     'support@nextlevel.net',
                     subject,
                     body,
                     to=dests,
                     cc=['accounting@nextlevel.net']
-                    )
-                if 'Error' in response:
-                    EMAIL_ERRORS.labels(organization=name).inc()
-                    LOGGER.error(f'failed to send email to { ", ".join(dests) }: { response["Error"] }')
-                else:
-                    EMAIL_SUCCESS.labels(organization=name).inc()
-                    LOGGER.info(f'sent email to { ", ".join(dests) }')
+                    )] = (name, d, dests)
+        for f in as_completed(sends):
+            (name, d, dests) = sends[f]
+            try:
+                response = f.result()
+            except Exception:
+                # botocore's ClientError, or e.g. its EndpointConnectionError
+                EMAIL_ERRORS.labels(organization=name).inc()
+                LOGGER.exception(f'failed to send email to { ", ".join(dests) }')
+                failed.append((name, d))
+                continue
+            if response is None:
+                continue  # SES is not configured; send() already said so
+            if 'Error' in response:
+                EMAIL_ERRORS.labels(organization=name).inc()
+                LOGGER.error(f'failed to send email to { ", ".join(dests) }: { response["Error"] }')
+                failed.append((name, d))
+            else:
+                EMAIL_SUCCESS.labels(organization=name).inc()
+                LOGGER.info(f'sent email to { ", ".join(dests) }')
+        return failed
+
+    def _fetch_org(self, org, reusable):
+        """Returns (org, clients, services), or (org, None, None) if
+        reusable and UISP reports that neither the clients nor the services
+        of org have changed since the last refresh."""
+        LOGGER.info(f'refreshing UISP organization {org["name"]}')
+        not_modified = UNMODIFIED if reusable else None
+        clients = self.uisp.get_clients_of(org, not_modified=not_modified)
+        services = self.uisp.get_services_of(org, not_modified=not_modified)
+        if clients is UNMODIFIED and services is UNMODIFIED:
+            return (org, None, None)
+        # only one of them changed, but services are annotated from their
+        # clients, so we need both
+        if clients is UNMODIFIED:
+            clients = self.uisp.get_clients_of(org)
+        if services is UNMODIFIED:
+            services = self.uisp.get_services_of(org)
+        return (org, clients, services)
+
+    def _annotate_speeds(self, s):
+        plan = self.serviceplans.get(s['servicePlanId'], {})
+        s['downloadSpeed'] = plan.get('downloadSpeed', -1)
+        s['uploadSpeed'] = plan.get('uploadSpeed', -1)
 
     @REQUEST_TIME.time()
     def _refresh(self):
-        self.serviceplans = { plan['id']: plan for plan in self.uisp.get_service_plans() }
-        for org in self.uisporgs:
-            LOGGER.info(f'refreshing UISP organization {org["name"]}')
-            orgid = org['id']
-            clients = self.uisp.get_clients_of(org)
-            self.id2client_map = { c['id']: c for c in clients }
-            self.id2allclients_map.update(self.id2client_map)
-            services = self.uisp.get_services_of(org)
-            for s in services:
-                self.id2service_map[s['id']] = dict(s, userIdent=self.id2client_map.get(s['clientId'], { 'userIdent': -1 })['userIdent'], downloadSpeed=self.serviceplans[s['servicePlanId']].get('downloadSpeed', -1), uploadSpeed=self.serviceplans[s['servicePlanId']].get('uploadSpeed', -1))
+        # build new maps and publish them together at the end, so scrapes
+        # never see a partially refreshed snapshot
+        new_clients, new_services, new_contacts = {}, {}, {}
+        # if this refresh fails part way, UISP may have given us new data we
+        # never processed, so nothing is reused until one succeeds
+        org_parts, self.org_parts, new_org_parts = self.org_parts, {}, {}
+        # the service plan and per-organization requests are independent,
+        # so overlap them
+        with ThreadPoolExecutor(max_workers=min(self.MAX_FETCH_WORKERS, len(self.uisporgs) + 1)) as executor:
+            plans_fetch = None
+            if not self.serviceplans or time.time() - self.serviceplans_time > self.SERVICE_PLANS_TTL:
+                plans_fetch = executor.submit(self.uisp.get_service_plans, not_modified=UNMODIFIED if self.serviceplans else None)
+            fetches = [executor.submit(self._fetch_org, org, org['id'] in org_parts) for org in self.uisporgs]
+            plans = plans_fetch.result() if plans_fetch else UNMODIFIED
+            plans_changed = plans is not UNMODIFIED
+            if plans_changed:
+                self.serviceplans = dict(zip(map(_get_id, plans), plans))
+            if plans_fetch:
+                self.serviceplans_time = time.time()
+            for f in as_completed(fetches):
+                (org, clients, services) = f.result()
+                if clients is None:
+                    (org_clients, org_services, org_contacts) = org_parts[org['id']]
+                    if plans_changed:
+                        for s in org_services.values():
+                            self._annotate_speeds(s)
+                else:
+                    org_contacts = {}
+                    for c in clients:
+                        parse_dates(c, CLIENT_DATE_KEYS)
+                        c['_clientstate'] = ClientStatus.from_client(c).value
+                        # contacts are served as-is, so give them their client's
+                        # userIdent and flatten their types to a label value
+                        for contact in c['contacts']:
+                            contact['userIdent'] = c['userIdent']
+                            contact['types'] = ','.join(sorted(t['name'] for t in contact['types']))
+                            org_contacts[contact['id']] = contact
+                    org_clients = dict(zip(map(_get_id, clients), clients))
+                    for s in services:
+                        # services are freshly decoded each refresh, so we
+                        # annotate them in place rather than copying them
+                        client = org_clients.get(s['clientId'])
+                        s['userIdent'] = client['userIdent'] if client else -1
+                        self._annotate_speeds(s)
+                        parse_dates(s, SERVICE_DATE_KEYS)
+                    org_services = dict(zip(map(_get_id, services), services))
+                new_org_parts[org['id']] = (org_clients, org_services, org_contacts)
+                new_clients.update(org_clients)
+                new_services.update(org_services)
+                new_contacts.update(org_contacts)
+        summary_by_org, orgid_by_plan = defaultdict(lambda: ([], [], [])), {}
+        active = ClientStatus.ACTIVE.value
+        for c in new_clients.values():
+            (org_active, org_pastdue, org_noautopay) = summary_by_org[c['organizationId']]
+            if c['isArchived']:
+                continue
+            if c['hasOverdueInvoice']:
+                org_pastdue.append(c)
+            if c['_clientstate'] == active:
+                org_active.append(c)
+                if not c['hasAutopayCreditCard']:
+                    org_noautopay.append(c)
+        active = ServiceStatus.ACTIVE.value
+        for s in new_services.values():
+            if s['status'] == active and s['servicePlanId'] not in orgid_by_plan and s['clientId'] in new_clients:
+                orgid_by_plan[s['servicePlanId']] = new_clients[s['clientId']]['organizationId']
+        with self._snapshot_lock:
+            self.id2allclients_map, self.id2service_map, self.id2contact_map = new_clients, new_services, new_contacts
+            self.summary_by_org, self.orgid_by_plan = summary_by_org, orgid_by_plan
+            self.printable_by_id = {}
+        self.org_parts = new_org_parts
+        self._adapt_update_interval(new_clients, new_services)
+
+    def _adapt_update_interval(self, new_clients, new_services):
+        """Double the update interval (up to MAX_UPDATE_INTERVAL) once
+        UNCHANGED_REFRESHES_BEFORE_BACKOFF refreshes in a row have produced
+        an identical snapshot, and go back to MIN_UPDATE_INTERVAL as soon as
+        anything changes."""
+        digest = hashlib.blake2b(orjson.dumps([new_clients, new_services], option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)).digest()
+        if digest != self._snapshot_digest:
+            self._snapshot_digest, self._unchanged_refreshes = digest, 0
+            self.update_interval = self.MIN_UPDATE_INTERVAL
+            return
+        self._unchanged_refreshes += 1
+        if self._unchanged_refreshes >= self.UNCHANGED_REFRESHES_BEFORE_BACKOFF and self.update_interval < self.MAX_UPDATE_INTERVAL:
+            self.update_interval = min(2 * self.update_interval, self.MAX_UPDATE_INTERVAL)
+            LOGGER.info(f'UISP data unchanged for {self._unchanged_refreshes} refreshes; refreshing every {self.update_interval} seconds')
+
 
+def start_metrics_server(port):
+    """Serve /metrics on port from a daemon thread, handling each scrape on
+    its own thread so that concurrent scrapers never wait on each other."""
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def wait_for_shutdown():
+    """Block the calling (main) thread until SIGTERM or SIGINT arrives."""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    stop.wait()
 
 
 def main(args):
@@ -372,13 +608,16 @@ def main(args):
     if vals.port:
         if vals.emailday < 0 or vals.emailday > 6:
             LOGGER.info('--emailday does not specify a valid day: no weekly summary email will be sent')
+        elif vals.emailhour < 0 or vals.emailhour > 23:
+            LOGGER.info('--emailhour does not specify a valid hour: no weekly summary email will be sent')
         else:
             LOGGER.info('will send weekly email subscriber summaries')
         wrapper = PrometheusWrapper(config, vals.emailday, vals.emailhour)
         LOGGER.info(f'serving metrics on port {vals.port}')
-        prometheus_client.start_http_server(vals.port)
-        while True:
-            time.sleep(3600)
+        start_metrics_server(vals.port)
+        wait_for_shutdown()
+        LOGGER.info('shutting down')
+        return 0
     else:
         LOGGER.warning('--port option not specified; exiting')
     return 1
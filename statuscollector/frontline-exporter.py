@@ -1,15 +1,14 @@
 #!/usr/bin/env python3
 # frontline-exporter.py - read subscriber state from Plume Frontline
 
-import logging, threading, time, yaml
-from collections import namedtuple
-from datetime import datetime
-from enum import Enum
+import functools, gzip, heapq, logging, os, threading, time, yaml
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-import botocore, boto3, prometheus_client, requests.exceptions
+import orjson, prometheus_client, requests.exceptions
 
 from frontline import FrontlineClient
-from exporter import ModelGauge, EmailSender
+from exporter import ModelCollector, EmailSender, start_metrics_server, wait_for_shutdown
 
 
 LOGGER = logging.getLogger('statuscollector.frontline-exporter')
@@ -24,27 +23,64 @@ EMAIL_ERRORS = prometheus_client.Gauge('frontline_email_error_count',
                                        'number of email sending errors', ['organization'])
 
 
-class FrontlineGauge:
-    def __init__(self, metric, metric_desc, labelmap, model, value_selector):
-        """
-        Model is a function of zero arguments that returns a map from id
-        to dictionary.
-        """
-        def _selector(model_dict):
-            v = value_selector(model_dict)
-            if v is None or v is False:
-                return 0
-            if v is True:
-                return 1
-            if isinstance(v, str):
-                # then it should be a date 2023-10-03T00:00:00-0700
-                return datetime.fromisoformat(v).timestamp()
-            return v
-        self.gauge = ModelGauge(metric, metric_desc, labelmap, 'id', model, _selector)
-        self.update()
-
-    def update(self):
-        self.gauge.update()
+@functools.lru_cache(maxsize=1 << 16)
+def iso_timestamp(v):
+    # nodes are refetched every few minutes but most of their dates (boot,
+    # claim, speedtest) do not change, so we parse each string only once
+    return datetime.fromisoformat(v).timestamp()
+
+
+def frontline_gauge_value(v):
+    if v is None or v is False:
+        return 0
+    if v is True:
+        return 1
+    if isinstance(v, str):
+        # then it should be a date 2023-10-03T00:00:00-0700
+        return iso_timestamp(v)
+    return v
+
+
+# labelmaps from model dictionary key to exported label
+CUSTOMER_IDENTMAP = { 'id': 'custid', 'accountId': 'nlid' }
+CUSTOMER_LABELMAP = dict({ k: k for k in ['name', 'locked', 'acceptLanguage', 'email'] }, **CUSTOMER_IDENTMAP)
+NODE_IDENTMAP = { 'id': 'id', 'nlid': 'nlid' }
+NODE_LABELMAP = { k: k for k in ['id', 'nlid', 'custid', 'locid', 'model', 'mac', 'ethernet1Mac', 'serialNumber', 'shipDate', 'partNumber', 'firmwareVersion', 'nickname', 'backhaulType', 'ip', 'wanIp', 'publicIp', 'openSyncVersion'] }
+LINK_LABELMAP = dict({ k: k for k in ['nlid', 'ifName', 'duplex', 'isUplink', 'hasEthClient'] }, nodeid='id')
+PARENT_LABELMAP = { k: k for k in ['id', 'nlid', 'radio', 'parentId'] }
+SPEED_IDENTMAP = { 'id': 'id', 'nlid': 'nlid' }
+SPEED_LABELMAP = dict({ k: k for k in ['trigger', 'gateway', 'serverIp', 'serverHost', 'serverId' ] }, **SPEED_IDENTMAP)
+CHANNEL_LABELMAP = dict({ k: k for k in ['nlid', 'freqBand', 'channelWidth'] }, nodeid='id')
+
+
+def radio_fallback(d):
+    channel = d['leafToRoot'][0].get('channel', d.get('backhaulChannel'))
+    if channel is not None:
+        for band in ['2g', '5gu', '5gl', '5g', '6g']:
+            if channel == d.get(f'{band}Channel'):
+                return band.upper()
+        return 'unknown_band'
+    return 'unknown_channel'
+
+
+def parent_wifi_channel(d):
+    if d.get('backhaulType', '') != 'wifi':
+        return -1
+    channel = d['leafToRoot'][0].get('channel')
+    if channel is not None:
+        return channel
+    return d.get('backhaulChannel', -99)
+
+
+def nli_channel(node, stat):
+    lowerc = stat['freqBand'].lower()
+    channel = node.get(f'{lowerc}Channel')
+    if channel is not None:
+        return channel
+    if stat['freqBand'] == '2.4G':
+        return node['2gChannel']
+    LOGGER.info(f'unknown freqBand {stat["freqBand"]} for node {node}')
+    return -999
 
 
 class PrometheusWrapper:
@@ -54,6 +90,12 @@ class PrometheusWrapper:
 
     # per metrics query, we allow this many seconds of node updates
     NODE_UPDATE_INTERVAL = 10
+    # gauge values are set when the models are refreshed, so a background
+    # thread checks this often whether a refresh is due
+    REFRESH_POLL_INTERVAL = MIN_NODE_UPDATE_INTERVAL
+    # at most this many locations' nodes are fetched concurrently; this
+    # should not exceed FrontlineClient.POOL_MAXSIZE
+    MAX_FETCH_WORKERS = 16
                             
     def __init__(self, config, emailday, emailhour):
         self.config, self.emailday, self.emailhour = config, emailday, emailhour
@@ -61,141 +103,181 @@ class PrometheusWrapper:
         
         self.last_location_update, self.last_node_update, self.last_email = 0, 0, 0
         self.errors = 0
-        self.lock = threading.Lock()
+        # _time_lock guards the last_*_update and last_email timestamps and is
+        # never held across network requests; _node_lock is held while the
+        # nodes are refreshed
+        self._time_lock = threading.Lock()
+        self._node_lock = threading.Lock()
         self.emailer = EmailSender(self.config)
+        self.fetch_executor = ThreadPoolExecutor(max_workers=self.MAX_FETCH_WORKERS)
         self.id2customer_map = {}
         self.id2location_map = {}
         self.id2node_map = {}
-        self.gauges = []
-        self.nodegauges = []
+        # incremented after each node refresh, so models derived from the
+        # nodes can be rebuilt once per refresh rather than once per gauge
+        self.node_generation = 0
+        # locid -> when its nodes were last fetched, and a heap of (that
+        # time, locid) built from id2location_map (loc_heap_source) so that
+        # the least recently fetched locations are fetched next
+        self.loc_refresh_time, self.loc_heap, self.loc_heap_source = {}, [], None
+        # scrapes are computed from the current maps, which are refreshed
+        # here and then periodically from the background thread below
+        self.collector = ModelCollector()
+        # if set, customers and locations are saved here after each refresh
+        # and reused by the next process if they are recent enough
+        self.snapshot_file = self.config.get('frontline', {}).get('snapshot_file')
+        if self.snapshot_file:
+            self._load_snapshot()
         self._maybe_refresh()
 
-        labelmap = { k: k for k in ['name', 'locked', 'acceptLanguage', 'email'] }
-        labelmap['id'] = 'custid'
-        labelmap['accountId'] = 'nlid'
-        def _custmodel():
-            self._maybe_refresh()
-            return self.id2customer_map
-        self.gauges.append(FrontlineGauge('frontline_customer_email_verified', '1 if email verified, 0 otherwise', labelmap, _custmodel, lambda model_dict: model_dict.get('emailVerified', 0)))
-        self.gauges.append(FrontlineGauge('frontline_customer_created_ts', 'When the customer was created', { 'id': 'custid', 'accountId': 'nlid' }, _custmodel, lambda model_dict: model_dict['createdAt']))
-        self.gauges.append(FrontlineGauge('frontline_customer_first_login_ts', 'When the customer first logged in successfully, 0=never', { 'id': 'custid', 'accountId': 'nlid' }, _custmodel, lambda model_dict: model_dict.get('firstKnownLoginTimestamp', 0)))
-
-        nodelabelmap = { k: k for k in ['id', 'nlid', 'custid', 'locid', 'model', 'mac', 'ethernet1Mac', 'serialNumber', 'shipDate', 'partNumber', 'firmwareVersion', 'nickname', 'backhaulType', 'ip', 'wanIp', 'publicIp', 'openSyncVersion'] }
-        def _nodemodel():
-            self._maybe_refresh()
-            return self.id2node_map
-        self.nodegauges.append(FrontlineGauge('frontline_node_info', 'Node informational labels', nodelabelmap, _nodemodel, lambda d: 1))
-        identmap = { 'id': 'id', 'nlid': 'nlid' }
-        self.nodegauges.append(FrontlineGauge('frontline_node_health', 'Health score of the node, -1=not connected', identmap, _nodemodel, lambda d: -1 if d['connectionState'] != 'connected' else d.get('health', {}).get('score', -2)))
-        self.nodegauges.append(FrontlineGauge('frontline_node_is_bridge', '1 iff node is in bridge mode', identmap, _nodemodel, lambda d: d.get('networkMode', '') == 'bridge'))
-        self.nodegauges.append(FrontlineGauge('frontline_node_connected_devices', 'Count of devices connected to the node', identmap, _nodemodel, lambda d: d.get('connectedDeviceCount', -1)))
-        self.nodegauges.append(FrontlineGauge('frontline_node_connectivity_change_ts', 'Timestamp at which connection state changed', identmap, _nodemodel, lambda d: d.get('connectionStateChangeAt', -1)))
-        self.nodegauges.append(FrontlineGauge('frontline_node_boot_ts', 'Timestamp at which node booted', identmap, _nodemodel, lambda d: d.get('bootAt', -1)))
-        self.nodegauges.append(FrontlineGauge('frontline_node_claim_ts', 'Timestamp at which node was claimed', identmap, _nodemodel, lambda d: d['claimedAt']))
-        def _linkmodel():
-            self._maybe_refresh()
-            return { f'{node["id"]}-{link["ifName"]}': dict(link, id=f'{node["id"]}-{link["ifName"]}', nlid=node['nlid'], nodeid=node['id']) for node in self.id2node_map.values() if 'linkStates' in node for link in node.get('linkStates', []) }
-        linkmap = { k: k for k in ['nlid', 'ifName', 'duplex', 'isUplink', 'hasEthClient'] }
-        linkmap['nodeid'] = 'id'
-        self.nodegauges.append(FrontlineGauge('frontline_node_link_speed', 'Speed of link, 65535=no link', linkmap, _linkmodel, lambda d: d['linkSpeed']))
-        def _radiofallback(d):
-            channel = d['leafToRoot'][0].get('channel', d.get('backhaulChannel'))
-            if channel is not None:
-                for band in ['2g', '5gu', '5gl', '5g', '6g']:
-                    if channel == d.get(f'{band}Channel'):
-                        return band.upper()
-                return 'unknown_band'
-            return 'unknown_channel'
-        def _parentmodel():
-            self._maybe_refresh()
-            return { nodeid: dict(node, radio=node['leafToRoot'][0].get('radio', _radiofallback(node)), parentId=node['leafToRoot'][0]['id']) for (nodeid, node) in self.id2node_map.items() if node.get('leafToRoot') }
-        parentmap = { k: k for k in ['id', 'nlid', 'radio', 'parentId'] }
-        def _channelselector(d):
-            if d.get('backhaulType', '') != 'wifi':
-                return -1
-            channel = d['leafToRoot'][0].get('channel')
-            if channel is not None:
-                return channel
-            return d.get('backhaulChannel', -99)
-        self.nodegauges.append(FrontlineGauge('frontline_node_parent_wifi_channel', '-1 iff link to parent node is not wifi', parentmap, _parentmodel, _channelselector))
-        def _speedmodel():
-            self._maybe_refresh()
-            return { node['id']: dict(node['speedTest'], id=node['id'], nlid=node['nlid']) for node in self.id2node_map.values() if node.get('speedTest') }
-        speedmap = { 'id': 'id', 'nlid': 'nlid' }
-        self.nodegauges.append(FrontlineGauge('frontline_node_speedtest_rtt', 'RTT of speedtest', speedmap, _speedmodel, lambda d: -1 if d['status'] != 'succeeded' else d['rtt']))
-        self.nodegauges.append(FrontlineGauge('frontline_node_upload_mbps', 'Upload speed of speedtest', speedmap, _speedmodel, lambda d: -1 if d['status'] != 'succeeded' else d['upload']))
-        self.nodegauges.append(FrontlineGauge('frontline_node_download_mbps', 'Download speed of speedtest', speedmap, _speedmodel, lambda d: -1 if d['status'] != 'succeeded' else d['download']))
-        speedmap.update({ k: k for k in ['trigger', 'gateway', 'serverIp', 'serverHost', 'serverId' ] })
-        self.nodegauges.append(FrontlineGauge('frontline_node_speedtest_start_ts', 'Start time for most recent speedtest', speedmap, _speedmodel, lambda d: d['startedAt']))
-
-        def _nlichannel(node, stat):
-            lowerc = stat['freqBand'].lower()
-            channel = node.get(f'{lowerc}Channel')
-            if channel is not None:
-                return channel
-            if stat['freqBand'] == '2.4G':
-                return node['2gChannel']
-            LOGGER.info(f'unknown freqBand {stat["freqBand"]} for node {node}')
-            return -999
-        def _channelmodel():
-            self._maybe_refresh()
-            return { f'{node["id"]}-{stat["freqBand"]}': dict(node, id=f'{node["id"]}-{stat["freqBand"]}', nodeid=node['id'], freqBand=stat['freqBand'], channelWidth=stat['channelWidth'], numPunctured=len(stat['puncturedChannels']), nlichannel=_nlichannel(node, stat)) for node in self.id2node_map.values() if 'radioStats' in node for stat in node.get('radioStats', []) }
-        channelmap = { k: k for k in ['nlid', 'freqBand', 'channelWidth'] }
-        channelmap['nodeid'] = 'id'
-        self.nodegauges.append(FrontlineGauge('frontline_node_channel', 'Channel in use for each frequency band', channelmap, _channelmodel, lambda d: d['nlichannel']))
+        self._add_gauge('frontline_customer_email_verified', '1 if email verified, 0 otherwise', CUSTOMER_LABELMAP, self._custmodel, lambda model_dict: model_dict.get('emailVerified', 0))
+        self._add_gauge('frontline_customer_created_ts', 'When the customer was created', CUSTOMER_IDENTMAP, self._custmodel, lambda model_dict: model_dict['createdAt'])
+        self._add_gauge('frontline_customer_first_login_ts', 'When the customer first logged in successfully, 0=never', CUSTOMER_IDENTMAP, self._custmodel, lambda model_dict: model_dict.get('firstKnownLoginTimestamp', 0))
+
+        self._add_gauge('frontline_node_info', 'Node informational labels', NODE_LABELMAP, self._nodemodel, lambda d: 1)
+        self._add_gauge('frontline_node_health', 'Health score of the node, -1=not connected', NODE_IDENTMAP, self._nodemodel, lambda d: -1 if d['connectionState'] != 'connected' else d.get('health', {}).get('score', -2))
+        self._add_gauge('frontline_node_is_bridge', '1 iff node is in bridge mode', NODE_IDENTMAP, self._nodemodel, lambda d: d.get('networkMode', '') == 'bridge')
+        self._add_gauge('frontline_node_connected_devices', 'Count of devices connected to the node', NODE_IDENTMAP, self._nodemodel, lambda d: d.get('connectedDeviceCount', -1))
+        self._add_gauge('frontline_node_connectivity_change_ts', 'Timestamp at which connection state changed', NODE_IDENTMAP, self._nodemodel, lambda d: d.get('connectionStateChangeAt', -1))
+        self._add_gauge('frontline_node_boot_ts', 'Timestamp at which node booted', NODE_IDENTMAP, self._nodemodel, lambda d: d.get('bootAt', -1))
+        self._add_gauge('frontline_node_claim_ts', 'Timestamp at which node was claimed', NODE_IDENTMAP, self._nodemodel, lambda d: d['claimedAt'])
+        linkmodel = self._per_node_refresh(self._linkmodel)
+        self._add_gauge('frontline_node_link_speed', 'Speed of link, 65535=no link', LINK_LABELMAP, linkmodel, lambda d: d['linkSpeed'])
+        parentmodel = self._per_node_refresh(self._parentmodel)
+        self._add_gauge('frontline_node_parent_wifi_channel', '-1 iff link to parent node is not wifi', PARENT_LABELMAP, parentmodel, parent_wifi_channel)
+        speedmodel = self._per_node_refresh(self._speedmodel)
+        self._add_gauge('frontline_node_speedtest_rtt', 'RTT of speedtest', SPEED_IDENTMAP, speedmodel, lambda d: -1 if d['status'] != 'succeeded' else d['rtt'])
+        self._add_gauge('frontline_node_upload_mbps', 'Upload speed of speedtest', SPEED_IDENTMAP, speedmodel, lambda d: -1 if d['status'] != 'succeeded' else d['upload'])
+        self._add_gauge('frontline_node_download_mbps', 'Download speed of speedtest', SPEED_IDENTMAP, speedmodel, lambda d: -1 if d['status'] != 'succeeded' else d['download'])
+        self._add_gauge('frontline_node_speedtest_start_ts', 'Start time for most recent speedtest', SPEED_LABELMAP, speedmodel, lambda d: d['startedAt'])
+        channelmodel = self._per_node_refresh(self._channelmodel)
+        self._add_gauge('frontline_node_channel', 'Channel in use for each frequency band', CHANNEL_LABELMAP, channelmodel, lambda d: d['nlichannel'])
+
+        prometheus_client.REGISTRY.register(self.collector)
+
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
 
         # frontline_node_channel: nodeid, nlid, radioStats['freqBand'], 'channelWidth', len('puncturedChannels') has value 2gChannel, 5guChannel, 5glChannel depending on freqBand
         # whether an alert is being shown
         # customers showing weirdness in number of optimization events.
 
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.REFRESH_POLL_INTERVAL)
+            # this is the only thread that refreshes, so whatever goes wrong
+            # is logged and retried at the next poll rather than ending it
+            try:
+                self._maybe_refresh()
+            except Exception:
+                LOGGER.exception('Frontline refresh failed')
+                self.errors += 1
+
+    def _add_gauge(self, metric, metric_desc, labelmap, model, value_selector):
+        self.collector.add_gauge(metric, metric_desc, labelmap, model, lambda d: frontline_gauge_value(value_selector(d)))
+
+    def _custmodel(self):
+        return self.id2customer_map
+
+    def _nodemodel(self):
+        return self.id2node_map
+
+    def _linkmodel(self):
+        model = {}
+        for node in self.id2node_map.values():
+            for link in node.get('linkStates', []):
+                linkid = f'{node["id"]}-{link["ifName"]}'
+                model[linkid] = dict(link, id=linkid, nlid=node['nlid'], nodeid=node['id'])
+        return model
+
+    def _parentmodel(self):
+        return { nodeid: dict(node, radio=node['leafToRoot'][0].get('radio', radio_fallback(node)), parentId=node['leafToRoot'][0]['id']) for (nodeid, node) in self.id2node_map.items() if node.get('leafToRoot') }
+
+    def _speedmodel(self):
+        return { node['id']: dict(node['speedTest'], id=node['id'], nlid=node['nlid']) for node in self.id2node_map.values() if node.get('speedTest') }
+
+    def _channelmodel(self):
+        model = {}
+        for node in self.id2node_map.values():
+            for stat in node.get('radioStats', []):
+                channelid = f'{node["id"]}-{stat["freqBand"]}'
+                # each row carries only what CHANNEL_LABELMAP and its selector
+                # use, rather than a copy of every field of its node
+                model[channelid] = { 'id': channelid, 'nodeid': node['id'], 'nlid': node['nlid'], 'freqBand': stat['freqBand'], 'channelWidth': stat['channelWidth'], 'numPunctured': len(stat['puncturedChannels']), 'nlichannel': nli_channel(node, stat) }
+        return model
+
+    def _per_node_refresh(self, build):
+        """Returns a model that calls build() at most once per node refresh."""
+        cache = [-1, None]  # [node_generation, model]
+        def _model():
+            if cache[0] != self.node_generation:
+                cache[1], cache[0] = build(), self.node_generation
+            return cache[1]
+        return _model
+
+    def _claim(self, attr, interval, now):
+        """If more than interval seconds have passed since the time in the
+        attribute attr, set it to now and return its old value. Otherwise
+        return None. At most one caller claims each interval."""
+        # fast path: nothing is due, so we don't need the lock
+        if now - getattr(self, attr) <= interval:
+            return None
+        with self._time_lock:
+            old = getattr(self, attr)
+            if now - old <= interval:
+                return None
+            setattr(self, attr, now)
+            return old
+
     def _maybe_refresh(self):
-        oldtime = -1
         newtime = time.time()
-        with self.lock:
-            if time.time() - self.last_location_update > self.MIN_UPDATE_INTERVAL:
-                oldtime = self.last_location_update
-                self.last_location_update = newtime
-            # safe to release the lock here because (we assume) that the
-            # min update interval is long enough that this method will exit
-            # before any other thread has oldtime != -1.
-        if oldtime != -1:
+        oldtime = self._claim('last_location_update', self.MIN_UPDATE_INTERVAL, newtime)
+        if oldtime is not None:
             try:
                 self._refresh()
-                for g in self.gauges:
-                    g.update()
-            except (requests.exceptions.ReadTimeout,
-                    requests.exceptions.ConnectionError):
-                LOGGER.exception()
+            except requests.exceptions.RequestException:
+                # this includes the RetryError of a status that stayed
+                # retryable through all of the session's retries
+                LOGGER.exception('Frontline customer and location refresh failed')
                 self.errors += 1
                 # reset the last update time so we try again pronto
-                with self.lock:
+                with self._time_lock:
                     if self.last_location_update == newtime:
                         self.last_location_update = oldtime
-        with self.lock:
-            do_update = False
-            if time.time() - self.last_node_update > self.MIN_NODE_UPDATE_INTERVAL:
+        if self._claim('last_node_update', self.MIN_NODE_UPDATE_INTERVAL, newtime) is not None:
+            # the first node refresh can outlast the interval, so this lock
+            # (and not the timestamp) keeps node refreshes from overlapping
+            with self._node_lock:
                 try:
                     self._refresh_some_nodes_locked()
-                    self.last_node_update = time.time()
-                except (requests.exceptions.ReadTimeout,
-                        requests.exceptions.ConnectionError):
-                    LOGGER.exception()
+                    with self._time_lock:
+                        self.last_node_update = time.time()
+                except requests.exceptions.RequestException:
+                    LOGGER.exception('Frontline node refresh failed')
                     self.errors += 1
-                do_update = True
-            # safe to release the lock here because g.update() is thread-safe
-        if do_update:
-            for g in self.nodegauges:
-                g.update()
-        with self.lock:
-            now = datetime.utcnow()
-            if (self.emailday == now.weekday() and self.emailhour <= now.hour
-                and time.time() - self.last_email > 3600*12):
+                # even a failed refresh may have updated some nodes
+                self.node_generation += 1
+        # the refreshes above may have taken a while, but being a few
+        # seconds late deciding whether the email is due does not matter
+        now = datetime.fromtimestamp(newtime, timezone.utc)
+        if self.emailday == now.weekday() and self.emailhour <= now.hour:
+            oldemail = self._claim('last_email', 3600*12, newtime)
+            if oldemail is not None:
+                # botocore is imported only once an email is due, so an
+                # exporter that never emails does not load it
+                import botocore.exceptions
+                sent = False
                 try:
                     self._send_email()
-                    self.last_email = time.time()
+                    sent = True
                 except botocore.exceptions.ClientError:
                     EMAIL_ERRORS.labels(organization='UNKNOWN').inc()
-                    LOGGER.exception()
+                    LOGGER.exception('failed to send summary emails')
+                finally:
+                    if not sent:
+                        # give back the claim so the next poll tries again
+                        with self._time_lock:
+                            if self.last_email == newtime:
+                                self.last_email = oldemail
 
     def _send_email(self):
         # see https://codelovingyogi.medium.com/sending-emails-using-aws-simple-email-service-ses-220de9db4fc8
@@ -218,6 +300,8 @@ class PrometheusWrapper:
                     to=dests,
                     cc=['accounting@nextlevel.net']
                     )
+                if response is None:
+                    continue  # SES is not configured; send() already said so
                 if 'Error' in response:
                     EMAIL_ERRORS.labels(organization=name).inc()
                     LOGGER.error(f'failed to send email to { ", ".join(dests) }: { response["Error"] }')
@@ -228,41 +312,133 @@ class PrometheusWrapper:
     @REQUEST_TIME.time()
     def _refresh(self):
         LOGGER.info('refreshing Frontline customers and locations')
-        self.id2customer_map = { cust['id']: cust for cust in self.frontline.get_customers() }
-        self.id2location_map = { loc['id']: dict(loc, custid=cust['id']) for cust in self.id2customer_map.values() for loc in self.frontline.get_locations_by_customerid(cust['id']) }
+        id2customer_map = { cust['id']: cust for cust in self.frontline.get_customers() }
+        # one request per customer, so we make them concurrently
+        custids = list(id2customer_map.keys())
+        id2location_map = { loc['id']: dict(loc, custid=custid) for (custid, locs) in zip(custids, self.fetch_executor.map(self.frontline.get_locations_by_customerid, custids)) for loc in locs }
+        self.id2customer_map, self.id2location_map = id2customer_map, id2location_map
         LOGGER.info('refresh complete')
+        if self.snapshot_file:
+            self._save_snapshot(time.time())
+
+    def _save_snapshot(self, ts):
+        tmpfile = f'{self.snapshot_file}.tmp'
+        try:
+            with gzip.open(tmpfile, 'wb') as f:
+                f.write(orjson.dumps({ 'ts': ts, 'customers': self.id2customer_map, 'locations': self.id2location_map }))
+            os.replace(tmpfile, self.snapshot_file)
+        except OSError:
+            LOGGER.exception(f'could not save snapshot to {self.snapshot_file}')
+
+    def _load_snapshot(self):
+        """If snapshot_file holds customers and locations saved less than
+        MIN_UPDATE_INTERVAL ago, use them until the next refresh is due, so
+        that a restart does not wait on every customer's locations."""
+        try:
+            with gzip.open(self.snapshot_file, 'rb') as f:
+                snapshot = orjson.loads(f.read())
+        except FileNotFoundError:
+            return
+        except (OSError, orjson.JSONDecodeError):
+            LOGGER.exception(f'ignoring unreadable snapshot {self.snapshot_file}')
+            return
+        # a snapshot of the wrong shape, e.g. from another version, counts
+        # as no snapshot rather than keeping the exporter from starting
+        try:
+            ts, customers, locations = snapshot['ts'], snapshot['customers'], snapshot['locations']
+            if not (isinstance(customers, dict) and isinstance(locations, dict)):
+                raise TypeError('customers and locations must be maps')
+            fresh = time.time() - ts <= self.MIN_UPDATE_INTERVAL
+        except (KeyError, TypeError):
+            LOGGER.exception(f'ignoring malformed snapshot {self.snapshot_file}')
+            return
+        if not fresh:
+            return
+        LOGGER.info(f'using Frontline customers and locations saved in {self.snapshot_file}')
+        self.id2customer_map, self.id2location_map = customers, locations
+        self.last_location_update = ts
+
+    def _fetch_nodes(self, loc):
+        """Returns (loc, its nodes), or (loc, None) if they could not be
+        fetched, so that one failing location does not cost the others in
+        its batch their results."""
+        try:
+            return (loc, self.frontline.get_nodes_by_customerid(loc['custid'], loc['id']))
+        except (requests.exceptions.RequestException, KeyError):
+            LOGGER.exception(f'could not fetch nodes of location {loc["id"]}')
+            return (loc, None)
 
     @REQUEST_NODE_TIME.time()
     def _refresh_some_nodes_locked(self):
-        def _upper(d, k):
-            v = d.get(k)
-            if v:
-                d[k] = v.upper()
         def _makedict(loc, node):
             # sonic_stats uses uppercase MAC addresses so we should too,
             # in order to join on them in Prometheus
-            _upper(node, 'mac')
-            _upper(node, 'ethernet1Mac')
-            return dict(node, nlid=self.id2customer_map[loc['custid']]['accountId'], custid=loc['custid'], locid=loc['id'])
+            mac = node.get('mac')
+            if mac:
+                node['mac'] = mac.upper()
+            mac = node.get('ethernet1Mac')
+            if mac:
+                node['ethernet1Mac'] = mac.upper()
+            # nodes are freshly decoded for each fetch, so we annotate them
+            # in place rather than copying them
+            node['nlid'], node['custid'], node['locid'] = self.id2customer_map[loc['custid']]['accountId'], loc['custid'], loc['id']
+            return node
         if self.id2node_map:
+            if self.loc_heap_source is not self.id2location_map:
+                # the locations were refreshed, so forget the ones that went
+                # away; new ones have never been fetched, so they go first
+                self.loc_refresh_time = { locid: self.loc_refresh_time.get(locid, 0) for locid in self.id2location_map }
+                self.loc_heap = [(t, locid) for (locid, t) in self.loc_refresh_time.items()]
+                heapq.heapify(self.loc_heap)
+                self.loc_heap_source = self.id2location_map
             start = time.time()
-            updated = 0
-            while time.time() - start < self.NODE_UPDATE_INTERVAL:
-                if self.next_location_to_update >= len(self.locations_to_update):
-                    self.next_location_to_update = 0
-                    LOGGER.info('updated nodes at all known locations; starting over')
-                locid = self.locations_to_update[self.next_location_to_update]
-                self.next_location_to_update += 1
-                loc = self.id2location_map[locid]
-                self.id2node_map.update({ node['id']: _makedict(loc, node) for node in self.frontline.get_nodes_by_customerid(loc['custid'], loc['id']) })
-                updated += 1
+            # scrapes read the node map concurrently, so rather than change
+            # it in place we collect this tick's nodes and, if there are any,
+            # publish a new map with them merged in. that is one shallow copy
+            # per tick, which is cheap next to a tick's requests.
+            updated = {}
+            try:
+                while time.time() - start < self.NODE_UPDATE_INTERVAL:
+                    # fetch a batch of locations at a time, one per worker
+                    batch = [heapq.heappop(self.loc_heap)[1] for _ in range(min(self.MAX_FETCH_WORKERS, len(self.loc_heap)))]
+                    if not batch:
+                        break
+                    try:
+                        for (loc, nodes) in self.fetch_executor.map(self._fetch_nodes, [self.id2location_map[locid] for locid in batch]):
+                            if nodes is None:
+                                self.errors += 1
+                                continue
+                            for node in nodes:
+                                updated[node['id']] = _makedict(loc, node)
+                            self.loc_refresh_time[loc['id']] = time.time()
+                    finally:
+                        # the whole batch goes to the back of the heap, even
+                        # the locations we failed to fetch, so that one which
+                        # keeps failing cannot stall the rotation. they are
+                        # tried again once the others have had their turn.
+                        now = time.time()
+                        for locid in batch:
+                            heapq.heappush(self.loc_heap, (now, locid))
+            finally:
+                if updated:
+                    self.id2node_map = { **self.id2node_map, **updated }
         else:
             # the first time, we grab them all
             LOGGER.info('refreshing all Frontline nodes')
-            self.id2node_map = { node['id']: _makedict(loc, node) for loc in self.id2location_map.values() for node in self.frontline.get_nodes_by_customerid(loc['custid'], loc['id']) }
+            id2node_map = {}
+            self.loc_refresh_time = {}
+            for (loc, nodes) in self.fetch_executor.map(self._fetch_nodes, self.id2location_map.values()):
+                if nodes is None:
+                    self.errors += 1
+                    # never fetched, so it goes first in the rotation
+                    self.loc_refresh_time[loc['id']] = 0
+                    continue
+                for node in nodes:
+                    id2node_map[node['id']] = _makedict(loc, node)
+                self.loc_refresh_time[loc['id']] = time.time()
+            self.id2node_map = id2node_map
             LOGGER.info('refresh complete')
-            self.locations_to_update = sorted(self.id2location_map.keys())
-            self.next_location_to_update = 0
+            self.loc_heap_source = None
 
 
 def main(args):
@@ -291,9 +467,10 @@ def main(args):
             LOGGER.info('will send weekly email subscriber summaries')
         wrapper = PrometheusWrapper(config, vals.emailday, vals.emailhour)
         LOGGER.info(f'serving metrics on port {vals.port}')
-        prometheus_client.start_http_server(vals.port)
-        while True:
-            time.sleep(3600)
+        start_metrics_server(vals.port)
+        wait_for_shutdown()
+        LOGGER.info('shutting down')
+        return 0
     else:
         LOGGER.warning('--port option not specified; exiting')
     return 1
@@ -7,8 +7,9 @@ Client for the Frontline API as documented in
 
 """
 
-import json, logging, prometheus_client, requests, string, time, threading
+import logging, orjson, prometheus_client, requests, string, time, threading
 import datetime, itertools, math, yaml
+from urllib3.util.retry import Retry
 
 from uisp import UispClient, Organizations
 from main import IdMapper
@@ -34,6 +35,13 @@ class FrontlineClientError(Exception):
 
 
 class FrontlineClient:
+    POOL_MAXSIZE = 16
+    # customers are listed at most this many per request
+    CUSTOMERS_PAGE_SIZE = 500
+    # and we stop paging after this many pages, in case the server ignores
+    # the offset but keeps returning full pages
+    MAX_CUSTOMER_PAGES = 1000
+
     def __init__(self, config):
         self.config = config.get('frontline', {})
         self.urlprefix = self.config.get('urlprefix')
@@ -52,7 +60,18 @@ class FrontlineClient:
         if not self.authbody:
             raise FrontlineClientError('no authbody in frontline config')
         self.timeout = self.config.get('timeout', 10)
+        # one session for all requests, so that connections (and their TLS
+        # handshakes) are reused, with transient failures retried
+        self.session = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.POOL_MAXSIZE, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # we refresh the JWT halfway through its lifetime; the lock keeps
+        # concurrent requests from all refreshing it at once
+        self.jwt_lock = threading.Lock()
         self.jwt = self._bearer_jwt_request()
+        self.jwt_refresh_time = self.jwt_request_time + self.jwt['expires_in'] / 2
 
     @REQUEST_TIME.time()
     def _bearer_jwt_request(self):
@@ -61,42 +80,41 @@ class FrontlineClient:
         LOGGER.info(f'presenting authtoken to refresh JWT')
         self.jwt_request_time = time.time()
         headers = { 'Authorization': self.authtoken }
-        resp = requests.post(self.authurl, headers=headers,
-                             timeout=self.timeout, data=self.authbody)
+        resp = self.session.post(self.authurl, headers=headers,
+                                 timeout=self.timeout, data=self.authbody)
         resp.raise_for_status()
         if resp.status_code == 204:
             return None
-        return resp.json()
+        return orjson.loads(resp.content)
 
     @REQUEST_TIME.time()
-    def bearer_json_request(self, command, path, data=None, json=None):
-        if time.time() - self.jwt_request_time > self.jwt['expires_in'] / 2:
-            self.jwt = self._bearer_jwt_request()
+    def bearer_json_request(self, method, path, data=None, json=None):
+        """Method is the HTTP method, e.g. 'GET' or 'POST'."""
+        if time.time() > self.jwt_refresh_time:
+            with self.jwt_lock:
+                if time.time() > self.jwt_refresh_time:
+                    self.jwt = self._bearer_jwt_request()
+                    self.jwt_refresh_time = self.jwt_request_time + self.jwt['expires_in'] / 2
         endpoint = '%s%s' % (self.urlprefix, path)
         headers = { 'Authorization': f'Bearer {self.jwt["access_token"]}' }
-        if data: # depending on command, data may not be allowed as an argument
-            resp = command(endpoint, headers=headers, timeout=self.timeout, data=data)
-        elif json:
-            resp = command(endpoint, headers=headers, timeout=self.timeout, json=json)
-        else:
-            resp = command(endpoint, headers=headers, timeout=self.timeout)
+        resp = self.session.request(method, endpoint, headers=headers, timeout=self.timeout, data=data, json=json)
         resp.raise_for_status()
         if resp.status_code == 204:
             return None
-        return resp.json()
+        return orjson.loads(resp.content)
 
     def get_customers_by_filter(self, jsonfilter=None):
         filt = f'?filter={jsonfilter}' if jsonfilter else ''
-        return self.bearer_json_request(requests.get, '/Customers' + filt)
+        return self.bearer_json_request('GET', '/Customers' + filt)
 
     def get_customers_by_partnerlabel(self, keyword):
-        return self.bearer_json_request(requests.get, f'/partners/customers/search/{keyword}')
+        return self.bearer_json_request('GET', f'/partners/customers/search/{keyword}')
         
     def search_customers_by_name(self, name, exact=False, limit=30, skip=0):
-        return self.bearer_json_request(requests.get, f'/partners/customers/search/{name}?field=name&exactMatch={"true" if exact else "false"}&limit={limit}&skip={skip}')
+        return self.bearer_json_request('GET', f'/partners/customers/search/{name}?field=name&exactMatch={"true" if exact else "false"}&limit={limit}&skip={skip}')
 
     def get_nodes_by_customerid(self, customerid, locationid):
-        return self.bearer_json_request(requests.get, f'/Customers/{customerid}/locations/{locationid}/nodes')['nodes']
+        return self.bearer_json_request('GET', f'/Customers/{customerid}/locations/{locationid}/nodes')['nodes']
 
     # also worth looking at
     # https://piranha-gamma.prod.us-west-2.aws.plumenet.io/api/Customers/642cc40d71d99d000a611549/locations/642cc40d71d99d000a61154b/appFacade/home?client_id=0oa16a2cw1IIfsm7N357
@@ -161,11 +179,25 @@ class FrontlineClient:
         return [x for xs in xss for x in xs]  # flatten
 
     def get_locations_by_customerid(self, customerid):
-        return self.bearer_json_request(requests.get, f'/Customers/{customerid}/locations')
-
-    def get_customers(self, offset=None):
-        filter = '{"offset":' + str(offset) + ',"limit":500}'
-        return self.bearer_json_request(requests.get, f'/Groups/{self.partnerid}/customers{"" if offset is None else "?filter={filter}"}')
+        return self.bearer_json_request('GET', f'/Customers/{customerid}/locations')
+
+    def get_customers(self):
+        """Yields every customer of our partner id, fetching them a page at
+        a time. Paging stops at an empty page, at one that has no customer
+        we have not already seen (as when the offset is ignored), or at a
+        page shorter than the one before it. A short first page might only
+        mean the server caps the limit, so we then ask for one more."""
+        offset, seen, pagesize = 0, set(), self.CUSTOMERS_PAGE_SIZE
+        for _ in range(self.MAX_CUSTOMER_PAGES):
+            filter = '{"offset":' + str(offset) + ',"limit":' + str(self.CUSTOMERS_PAGE_SIZE) + '}'
+            page = self.bearer_json_request('GET', f'/Groups/{self.partnerid}/customers?filter={filter}')
+            new = [c for c in page if c['id'] not in seen]
+            seen.update(c['id'] for c in new)
+            yield from new
+            if not new or (len(page) < pagesize and offset):
+                return
+            offset, pagesize = offset + len(page), len(page)
+        LOGGER.warning(f'stopped listing customers after {self.MAX_CUSTOMER_PAGES} pages of {self.CUSTOMERS_PAGE_SIZE}')
 
 
 def main(argv):
@@ -5,7 +5,8 @@ observium.py
 The Observium API as documented in https://docs.observium.org/api/
 """
 
-import datetime, json, logging, prometheus_client, requests, time
+import datetime, logging, orjson, prometheus_client, requests, time
+from urllib3.util.retry import Retry
 
 REQUEST_TIME = prometheus_client.Summary('observium_processing_seconds',
                                          'time of Observium API requests')
@@ -17,6 +18,8 @@ class ObserviumClientError(Exception):
 
 
 class ObserviumClient:
+    POOL_MAXSIZE = 16
+
     def __init__(self, config):
         self.config = config.get('observium', {})
         self.urlprefix = self.config.get('urlprefix')
@@ -28,40 +31,55 @@ class ObserviumClient:
         password = self.config.get('password')
         if not password:
             raise ObserviumClientError('no password in observium config')
-        self.basicauth = requests.auth.HTTPBasicAuth(username, password)
+        # one session for all requests, so that connections (and their TLS
+        # handshakes) are reused, with transient failures retried
+        self.session = self._make_session(self.config.get('cache_file'))
+        self.session.auth = requests.auth.HTTPBasicAuth(username, password)
+        retry = Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.POOL_MAXSIZE, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.devices_querystrings = self.config.get('devices_querystrings')
         if not self.devices_querystrings:
             raise ObserviumClientError('no devices_querystrings in observium config')
         self.timeout = self.config.get('timeout', 10)
 
+    def _make_session(self, cache_file):
+        """If cache_file is set, responses are kept in that SQLite file for
+        cache_seconds (default 300), and revalidated with the server's ETag
+        or Last-Modified after that, so repeated runs skip unchanged data."""
+        if not cache_file:
+            return requests.Session()
+        try:
+            import requests_cache
+        except ImportError:
+            raise ObserviumClientError('cache_file in observium config requires the requests-cache package')
+        return requests_cache.CachedSession(cache_file, backend='sqlite', expire_after=self.config.get('cache_seconds', 300), cache_control=True)
+
     @REQUEST_TIME.time()
-    def bearer_json_request(self, command, path, data=None, json=None):
+    def bearer_json_request(self, method, path, data=None, json=None):
+        """Method is the HTTP method, e.g. 'GET'."""
         endpoint = '%s%s' % (self.urlprefix, path)
-        headers = { }
-        if data: # depending on command, data may not be allowed as an argument
-            resp = command(endpoint, headers=headers, timeout=self.timeout, data=data, auth=self.basicauth)
-        elif json:
-            resp = command(endpoint, headers=headers, timeout=self.timeout, json=json, auth=self.basicauth)
-        else:
-            resp = command(endpoint, headers=headers, timeout=self.timeout, auth=self.basicauth)
+        resp = self.session.request(method, endpoint, timeout=self.timeout, data=data, json=json)
         resp.raise_for_status()
         if resp.status_code == 204:
             return None
-        return resp.json()
+        # the port lists are large, and orjson decodes them much faster
+        # than the stdlib json behind resp.json()
+        return orjson.loads(resp.content)
 
     def get_devices(self):
         devs = {}
         for qstring in self.devices_querystrings:
-            devices = self.bearer_json_request(requests.get, f'/devices/?{qstring}')
+            devices = self.bearer_json_request('GET', f'/devices/?{qstring}')
             status = devices['status']
             if status != 'ok':
                 raise ObserviumClientError(f'server returned status {status}', devices)
-            for k, v in devices['devices'].items():
-                devs[k] = v
+            devs.update(devices['devices'])
         return devs
 
     def get_ports(self, devicenum):
-        ports = self.bearer_json_request(requests.get, f'/ports/?device_id={devicenum}&fields=ifAlias,ifSpeed,ifAdminStatus')
+        ports = self.bearer_json_request('GET', f'/ports/?device_id={devicenum}&fields=ifAlias,ifSpeed,ifAdminStatus')
         status = ports['status']
         if status != 'ok':
             raise ObserviumClientError(f'server returned status {status}', ports)
@@ -6,8 +6,9 @@ The UISP API as documented in https://unmscrm.docs.apiary.io/#introduction
 and https://help.ui.com/hc/en-us/articles/115003906007-UISP-CRM-API-Usage
 """
 
-import json, logging, prometheus_client, requests, time, threading
+import logging, orjson, prometheus_client, requests, time, threading
 from enum import Enum
+from urllib3.util.retry import Retry
 
 REQUEST_TIME = prometheus_client.Summary('uisp_processing_seconds',
                                          'time of UISP API requests')
@@ -50,6 +51,10 @@ class ServiceStatus(Enum):
     INACTIVE  = 8
 
 
+# register_service tests every service against this
+_STATUS_ACTIVE = ServiceStatus.ACTIVE.value
+
+
 class InvoiceStatus(Enum):
     DRAFT     = 0
     UNPAID    = 1
@@ -60,10 +65,16 @@ class InvoiceStatus(Enum):
 
     @classmethod
     def may_be_paid(cls, status):
-        return status == InvoiceStatus.UNPAID.value or status == InvoiceStatus.PARTIALLY_PAID.value or status == InvoiceStatus.PAID.value
+        return status in _MAY_BE_PAID
+
+
+# kept outside InvoiceStatus, where it would become a member
+_MAY_BE_PAID = frozenset({ InvoiceStatus.UNPAID.value, InvoiceStatus.PARTIALLY_PAID.value, InvoiceStatus.PAID.value })
 
 
 class NoServicePlanWrapper:
+    __slots__ = ('owner', 'spid', 'values', 'active_services', 'target_actives', 'total_price')
+
     def __init__(self, spid):
         self.owner, self.spid, self.values = None, spid, {}
         self.active_services = 0
@@ -82,6 +93,8 @@ class NoServicePlanWrapper:
 
 class ServicePlanWrapper:
     DEFAULT_BILLING_RATE = 0.03
+    __slots__ = ('owner', 'spid', 'values', 'active_services', 'total_price', 'target_actives', 'management_per_service',
+                 'isp_per_service', 'monthly_connectivity_weight', 'connectivity_per_service', 'billing_fee')
 
     def __init__(self, owner, spid, values):
         self.owner, self.spid, self.values = owner, spid, values
@@ -110,7 +123,7 @@ class ServicePlanWrapper:
 class Organizations:
     def __init__(self, config):
         self.config = config.get('organizations', {})
-        self.owners = { k for k in self.config.keys() }
+        self.owners = set(self.config)
         self.spid2wrapper = {}
         for owner, d in self.config.items():
             for spid in (d['billing_instructions'] or {}).keys():
@@ -120,7 +133,7 @@ class Organizations:
         return self.spid2wrapper.get(spid)
 
     def register_service(self, service):
-        if service['status'] != ServiceStatus.ACTIVE.value:
+        if service['status'] != _STATUS_ACTIVE:
             return None
         spid = service['servicePlanId']
         wrapper = self.spid2wrapper.get(spid)
@@ -136,11 +149,13 @@ class Organizations:
 
 
 def currency_str(v):
-    vv = round(v, 2)
-    return '${:.2f}'.format(vv)
+    # the .2f format rounds correctly by itself
+    return f'${v:.2f}'
 
 
 class UispClient:
+    POOL_MAXSIZE = 16
+
     def __init__(self, config):
         self.config = config.get('uisp', {})
         self.urlprefix = self.config.get('urlprefix')
@@ -150,55 +165,130 @@ class UispClient:
         if not self.apikey:
             raise UispClientError('no apikey in uisp config')
         self.timeout = self.config.get('timeout', 10)
+        cache_file = self.config.get('cache_file')
+        # endpoint -> (validator headers, body) of the last GET response
+        # that had an ETag or Last-Modified, for conditional requests. an
+        # on-disk cache does its own revalidation, so then we keep none.
+        self.conditional = not cache_file
+        self.validated = {}
+        self.lock = threading.Lock()
+        # one session for all requests, so that connections (and their TLS
+        # handshakes) are reused. the pool is sized for concurrent fetches
+        # of several organizations.
+        self.session = self._make_session(cache_file)
+        self.session.headers.update({ 'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate', 'X-Auth-App-Key': self.apikey })
+        # transient gateway errors, rate limiting and dropped connections are
+        # retried with backoff here, honoring Retry-After, rather than failing
+        # the whole refresh. only GETs are retried; a PATCH may have applied.
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], allowed_methods=frozenset({'GET'}))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.POOL_MAXSIZE, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _make_session(self, cache_file):
+        """If cache_file is set, GET responses are kept in that SQLite file
+        for cache_seconds (default 300), and revalidated with the server's
+        ETag or Last-Modified after that, so repeated runs of main.py skip
+        unchanged data. The exporter is better served without it, by its
+        in-memory conditional requests."""
+        if not cache_file:
+            return requests.Session()
+        try:
+            import requests_cache
+        except ImportError:
+            raise UispClientError('cache_file in uisp config requires the requests-cache package')
+        # the API key is a session header, so it must be kept out of the
+        # cached requests along with requests-cache's default secrets
+        ignored = ['Authorization', 'X-API-KEY', 'access_token', 'api_key', 'X-Auth-App-Key']
+        return requests_cache.CachedSession(cache_file, backend='sqlite', expire_after=self.config.get('cache_seconds', 300), cache_control=True, allowable_methods=('GET',), ignored_parameters=ignored)
+
+    def close(self):
+        """Closes the session's pooled connections, and its cache_file."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     @REQUEST_TIME.time()
-    def bearer_json_request(self, command, path, data=None, json=None):
+    def bearer_json_request(self, method, path, data=None, json=None, not_modified=None):
+        """Method is the HTTP method, e.g. 'GET' or 'PATCH'.
+
+        If not_modified is not None and UISP answers that the result of this
+        GET has not changed since we last fetched it, returns not_modified
+        rather than decoding the earlier result again."""
         endpoint = '%s%s' % (self.urlprefix, path)
-        headers = { 'X-Auth-App-Key': self.apikey }
-        if data: # depending on command, data may not be allowed as an argument
-            resp = command(endpoint, headers=headers, timeout=self.timeout, data=data)
-        elif json:
-            resp = command(endpoint, headers=headers, timeout=self.timeout, json=json)
-        else:
-            resp = command(endpoint, headers=headers, timeout=self.timeout)
+        conditional = self.conditional and method == 'GET'
+        cached = self.validated.get(endpoint) if conditional else None
+        headers = cached[0] if cached else None
+        resp = self.session.request(method, endpoint, headers=headers, timeout=self.timeout, data=data, json=json)
         resp.raise_for_status()
         if resp.status_code == 204:
             return None
-        return resp.json()
+        if resp.status_code == 304 and cached:
+            if not_modified is not None:
+                return not_modified
+            # we decode the saved body again because callers modify what
+            # we return
+            return orjson.loads(cached[1])
+        if conditional:
+            validators = {}
+            if 'ETag' in resp.headers:
+                validators['If-None-Match'] = resp.headers['ETag']
+            if 'Last-Modified' in resp.headers:
+                validators['If-Modified-Since'] = resp.headers['Last-Modified']
+            with self.lock:
+                if validators:
+                    self.validated[endpoint] = (validators, resp.content)
+                else:
+                    self.validated.pop(endpoint, None)
+        # orjson decodes the (large) client and service lists much faster
+        # than the stdlib json behind resp.json()
+        return orjson.loads(resp.content)
 
     def get_organizations(self):
-        return self.bearer_json_request(requests.get, f'/organizations')
+        return self.bearer_json_request('GET', f'/organizations')
 
-    def get_service_plans(self):
-        return self.bearer_json_request(requests.get, f'/service-plans')
+    def get_service_plans(self, not_modified=None):
+        return self.bearer_json_request('GET', f'/service-plans', not_modified=not_modified)
 
-    def get_clients_of(self, organization):
-        return self.bearer_json_request(requests.get, f'/clients?organizationId={organization["id"]}')
+    def get_clients_of(self, organization, not_modified=None):
+        return self.bearer_json_request('GET', f'/clients?organizationId={organization["id"]}', not_modified=not_modified)
 
-    def get_services_of(self, organization):
-        return self.bearer_json_request(requests.get, f'/clients/services?organizationId={organization["id"]}')
+    def get_services_of(self, organization, not_modified=None):
+        return self.bearer_json_request('GET', f'/clients/services?organizationId={organization["id"]}', not_modified=not_modified)
 
     def get_invoices_of(self, organization, startdate='', enddate=''):
         cdf = f'&createdDateFrom={startdate}' if startdate else ''
         cdt = f'&createdDateTo={enddate}' if enddate else ''
-        return self.bearer_json_request(requests.get, f'/invoices?organizationId={organization["id"]}{cdf}{cdt}')
+        return self.bearer_json_request('GET', f'/invoices?organizationId={organization["id"]}{cdf}{cdt}')
 
     def get_payments(self, startdate, enddate=''):
         cdf = f'&createdDateFrom={startdate}'
         cdt = f'&createdDateTo={enddate}' if enddate else ''
-        return self.bearer_json_request(requests.get, f'/payments?order=createdDate{cdf}{cdt}')
+        return self.bearer_json_request('GET', f'/payments?order=createdDate{cdf}{cdt}')
 
     def get_custom_attributes(self):
-        return self.bearer_json_request(requests.get, '/custom-attributes')
+        return self.bearer_json_request('GET', '/custom-attributes')
 
     def patch_invoice_attribute(self, invoiceid, aid, value):
-        return self.bearer_json_request(requests.patch, f'/invoices/{invoiceid}?attributes%5B0%5D%5BcustomAttributeId%5D={aid}&attributes%5B0%5D%5Bvalue%5D={value}')
+        return self.bearer_json_request('PATCH', f'/invoices/{invoiceid}?attributes%5B0%5D%5BcustomAttributeId%5D={aid}&attributes%5B0%5D%5Bvalue%5D={value}')
 
     def patch_payment_attribute(self, paymentid, aid, value):
-        return self.bearer_json_request(requests.patch, f'/payments/{paymentid}?attributes%5B0%5D%5BcustomAttributeId%5D={aid}&attributes%5B0%5D%5Bvalue%5D={value}')
+        return self.bearer_json_request('PATCH', f'/payments/{paymentid}?attributes%5B0%5D%5BcustomAttributeId%5D={aid}&attributes%5B0%5D%5Bvalue%5D={value}')
 
     def name_of(self, client):
-        return f'{client["firstName"]} {client["lastName"]}' if client['firstName'] else f'COMPANY:{client["companyName"]}, {client["companyContactFirstName"]} {client["companyContactLastName"]}' if client['companyContactFirstName'] else f'COMPANY:{client["companyName"]}' if client['companyName'] else str(client)
+        first = client['firstName']
+        if first:
+            return f'{first} {client["lastName"]}'
+        company, contact = client['companyName'], client['companyContactFirstName']
+        if contact:
+            return f'COMPANY:{company}, {contact} {client["companyContactLastName"]}'
+        if company:
+            return f'COMPANY:{company}'
+        return str(client)
 
     def printable_client(self, client):
         b = client['accountBalance']
@@ -213,7 +303,10 @@ class UispClient:
         return f'{client["username"]} {name}{balance}{autopay}{pastdue}{active}{lead}{suspended}{invite}'
 
 
-def print_clients(clients, uisp, cids_with_new_service=set(), only=[]):
+def print_clients(clients, uisp, cids_with_new_service=frozenset(), only=frozenset(), printable_by_id=None):
+    """If printable_by_id is a dict, it keeps each client's printable_client()
+    so that a client printed again, e.g. under another service plan, is
+    formatted only once."""
     ## active_clients = [c for c in clients if c['isActive'] and not c['isArchived'] and not c['isLead']]
     def matching(client):
         matches = 0
@@ -224,16 +317,23 @@ def print_clients(clients, uisp, cids_with_new_service=set(), only=[]):
         if 'INACTIVE' in only and not client['isActive']:
             matches += 1
         return matches == len(only)
-    matching_clients = [c for c in clients if matching(c) and not c['isArchived'] and not c['isLead']]
-    for client in matching_clients:
-        newservice = 'NEWSERVICE' if client['id'] in cids_with_new_service else ''
-        if client['accountBalance'] > 0:
-            print(uisp.printable_client(client), newservice)
-    for client in matching_clients:
-        newservice = 'NEWSERVICE' if client['id'] in cids_with_new_service else ''
-        if client['accountBalance'] < 0:
-            print(uisp.printable_client(client), newservice)
-    for client in matching_clients:
-        newservice = 'NEWSERVICE' if client['id'] in cids_with_new_service else ''
-        if not client['accountBalance']:
-            print(uisp.printable_client(client), newservice)
+    # clients in credit are printed first, then those who owe, then the rest
+    credit, owing, even = [], [], []
+    for client in clients:
+        if matching(client) and not client['isArchived'] and not client['isLead']:
+            b = client['accountBalance']
+            (credit if b > 0 else owing if b < 0 else even).append(client)
+    lines = []
+    for client in credit + owing + even:
+        cid = client['id']
+        newservice = 'NEWSERVICE' if cid in cids_with_new_service else ''
+        if printable_by_id is None:
+            printable = uisp.printable_client(client)
+        else:
+            printable = printable_by_id.get(cid)
+            if printable is None:
+                printable = printable_by_id[cid] = uisp.printable_client(client)
+        lines.append(f'{printable} {newservice}')
+    # one write for the whole plan rather than one per client
+    if lines:
+        print('\n'.join(lines))